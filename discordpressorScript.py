@@ -3,43 +3,190 @@ import subprocess
 import os
 import json
 import shutil
+import struct
+import argparse
+import functools
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson as _json # Optional, parses ffprobe output faster than the json module
+except ImportError:
+    _json = json
+
+try:
+    import av # Optional, reads video info in-process instead of starting ffprobe
+except ImportError:
+    av = None
 
 
 # Constants
 MAX_SIZE_MB = 9
 DEFAULT_VIDEO_BITRATE = 5_000_000
+DEFAULT_CRF = 23
 AUDIO_BITRATE = 128_000
 MAX_HEIGHT_UNTIL_HALVE = 1440
 ENCODING_PRESET = "slower" # Choose from: ultrafast, superfast, veryfast, faster, fast, medium, slow, slower, veryslow
-
-FFPROBE_CMD = ["ffprobe", "-v", "error", "-select_streams", "v:0",
-               "-show_entries", "stream=width,height,r_frame_rate:format=duration",
-               "-of", "json"]
+FFMPEG_STDERR_LINES = 200 # Amount of ffmpeg output lines kept to show when an encode fails
+OVERSIZE_CHECK_FROM = 0.5 # Part of the video that must be encoded before an encode heading over the size limit is stopped early
+USE_HARDWARE_ENCODER = True # Use the GPU's H264 encoder (NVIDIA, Intel or Apple) when one is available
+USE_HARDWARE_DECODER = True # Let ffmpeg decode the input on the GPU when it can (falls back to the CPU otherwise)
+MAX_HARDWARE_JOBS = 2 # Files converted at once with a hardware encoder; consumer GPUs only allow a few encode sessions
+
+# Hardware encoders in order of preference: (encoder, common options, quality options for short videos)
+# NVENC needs -b:v 0, otherwise its default 2M bitrate becomes the VBR average and -cq barely matters.
+# QSV switches to CBR (padding every video up to the bitrate) when -b:v equals -maxrate, so its average
+# is kept below the cap; see hardware_bitrate_options for the long video path.
+HARDWARE_ENCODERS = (
+    ("h264_nvenc", ("-preset", "p6", "-tune", "hq", "-rc", "vbr"), ("-b:v", "0", "-cq", str(DEFAULT_CRF))),
+    ("h264_qsv", ("-preset", "veryslow"), ("-b:v", str(DEFAULT_VIDEO_BITRATE * 9 // 10))),
+    ("h264_videotoolbox", (), ("-b:v", str(DEFAULT_VIDEO_BITRATE))),
+)
+# Encoders for the --codec option besides h264: (encoder, common options, quality options)
+# These always use CRF capped at the target bitrate, which keeps them within the size limit without two passes
+CRF_ENCODERS = {
+    "hevc": ("libx265", ("-preset", "medium", "-tag:v", "hvc1"), ("-crf", "26")),
+    "av1": ("libsvtav1", ("-preset", "6", "-svtav1-params", "tune=0:film-grain=0"), ("-crf", "30")),
+}
+LIBX264_VIDEO_OPTIONS = ("-c:v", "libx264", "-preset", ENCODING_PRESET)
+LIBX264_QUALITY_OPTIONS = ("-crf", str(DEFAULT_CRF))
+
+# Two-pass decodes the input twice, so decode it on the GPU when possible to keep that cheap
+INPUT_OPTIONS = ("-hwaccel", "auto") if USE_HARDWARE_DECODER else ()
+COMMON_FFMPEG_OPTIONS = ("-c:a", "aac", "-b:a", str(AUDIO_BITRATE),
+                         "-movflags", "+faststart", "-hide_banner", "-loglevel", "error", "-stats")
+
+# Largest result that still counts as fitting (see the README: results may be up to 0.5MB over)
+MAX_OUTPUT_BYTES = int((MAX_SIZE_MB + 0.5) * 1024 * 1024)
+
+# Resolved once so every call skips the PATH search; main() stops early when they're missing
+FFMPEG = shutil.which("ffmpeg")
+FFPROBE = shutil.which("ffprobe")
+
+FFPROBE_CMD = (FFPROBE, "-v", "error", "-probesize", "1M", "-analyzeduration", "1M",
+               "-show_entries", "stream=codec_type,codec_name,width,height,r_frame_rate:format=duration",
+               "-of", "json=c=1")
+
+# (width, height, duration, fps, video codec, audio codec) when the video info can't be read
+NO_VIDEO_INFO = (None, None, None, None, None, None)
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "discordpressor")
+PROBE_CACHE_DIR = os.path.join(CACHE_DIR, "probe")
+DONE_CACHE_PATH = os.path.join(CACHE_DIR, "done.json")
 
 
 def get_video_info(filepath):
-    cmd = FFPROBE_CMD + [filepath]
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        data = json.loads(result.stdout)
+        st = os.stat(filepath)
+    except OSError as e:
+        print(f"Error reading file info for {filepath}: {e}")
+        return NO_VIDEO_INFO
+    return _cached_video_info(os.path.abspath(filepath), st.st_mtime_ns, st.st_size)
+
+def _probe_cache_path(filepath):
+    key = hashlib.blake2b(filepath.encode(errors='surrogateescape'), digest_size=16).hexdigest()
+    return os.path.join(PROBE_CACHE_DIR, f"{key}.json")
 
-        if not data.get('streams') or not data['streams']:
+def load_probe_cache(filepath, mtime_ns, size):
+    try:
+        with open(_probe_cache_path(filepath), encoding='utf-8') as f:
+            entry = json.load(f)
+        if (entry['path'] == filepath and entry['mtime_ns'] == mtime_ns and entry['size'] == size
+                and len(entry['info']) == len(NO_VIDEO_INFO)):
+            return tuple(entry['info'])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def save_probe_cache(filepath, mtime_ns, size, info):
+    cache_path = _probe_cache_path(filepath)
+    entry = {'path': filepath, 'mtime_ns': mtime_ns, 'size': size, 'info': list(info)}
+    try:
+        os.makedirs(PROBE_CACHE_DIR, exist_ok=True)
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+    except OSError as e:
+        print(f"Warning: Could not write probe cache {cache_path}: {e}")
+
+@functools.lru_cache(maxsize=256)
+def _cached_video_info(filepath, mtime_ns, size):
+    # mtime and size are part of the key so an edited file is probed again
+    info = load_probe_cache(filepath, mtime_ns, size)
+    if info is not None:
+        return info
+    info = probe_video_info(filepath)
+    if None not in info[:3]:
+        save_probe_cache(filepath, mtime_ns, size, info)
+    return info
+
+def probe_video_info(filepath):
+    if av is not None:
+        info = probe_video_info_pyav(filepath)
+        if None not in info[:3]:
+            return info
+        if FFPROBE is None:
+            print(f"Error: PyAV could not read video info for {filepath}, and ffprobe is not available to try instead.")
+            return NO_VIDEO_INFO
+    return probe_video_info_ffprobe(filepath)
+
+def probe_video_info_pyav(filepath):
+    # Any problem here is silently left to the ffprobe path, which reports errors properly
+    try:
+        with av.open(filepath) as container:
+            if not container.streams.video:
+                return NO_VIDEO_INFO
+            stream = container.streams.video[0]
+            width = stream.codec_context.width
+            height = stream.codec_context.height
+            if container.duration is not None:
+                duration = float(container.duration) / av.time_base
+            elif stream.duration is not None and stream.time_base is not None:
+                duration = float(stream.duration * stream.time_base)
+            else:
+                return NO_VIDEO_INFO
+            original_fps = float(stream.average_rate) if stream.average_rate else None
+            # codec_context.name is the decoder (e.g. libdav1d); canonical_name matches what ffprobe reports
+            video_codec = stream.codec_context.codec.canonical_name
+            audio_codec = container.streams.audio[0].codec_context.codec.canonical_name if container.streams.audio else None
+    except Exception:
+        return NO_VIDEO_INFO
+
+    if not width or not height or duration <= 0:
+        return NO_VIDEO_INFO
+    if original_fps is not None and original_fps <= 0:
+        original_fps = None
+    return width, height, duration, original_fps, video_codec, audio_codec
+
+def probe_video_info_ffprobe(filepath):
+    cmd = (*FFPROBE_CMD, filepath)
+    try:
+        result = subprocess.run(cmd, capture_output=True, check=True)
+        data = _json.loads(result.stdout)
+
+        streams = data.get('streams') or []
+        video_streams = [stream for stream in streams if stream.get('codec_type') == 'video']
+        audio_streams = [stream for stream in streams if stream.get('codec_type') == 'audio']
+        if not video_streams:
             print(f"Error: No video streams found in ffprobe output for {filepath}.")
-            return None, None, None, None
-        stream_info = data['streams'][0]
+            return NO_VIDEO_INFO
+        stream_info = video_streams[0]
+        video_codec = stream_info.get('codec_name')
+        audio_codec = audio_streams[0].get('codec_name') if audio_streams else None
 
         width_raw = stream_info.get('width')
         height_raw = stream_info.get('height')
         
         if 'format' not in data or 'duration' not in data['format']:
             print(f"Error: Duration not found in ffprobe output format section for {filepath}.")
-            return None, None, None, None
+            return NO_VIDEO_INFO
         duration_str = data['format'].get('duration')
 
         if width_raw is None or height_raw is None or duration_str is None:
             print(f"Error: Missing essential video info (W, H, or D) for {filepath}. "
                   f"W:{width_raw}, H:{height_raw}, D_str:{duration_str}")
-            return None, None, None, None
+            return NO_VIDEO_INFO
 
         try:
             width = int(width_raw)
@@ -47,10 +194,10 @@ def get_video_info(filepath):
             duration = float(duration_str)
             if duration <= 0:
                 print(f"Error: Video duration ({duration}s) for {filepath} is not positive.")
-                return None, None, None, None
+                return NO_VIDEO_INFO
         except ValueError as e:
             print(f"Error converting essential video info (W, H, D) to number for {filepath}: {e}")
-            return None, None, None, None
+            return NO_VIDEO_INFO
 
         original_fps = None
         r_frame_rate_str = stream_info.get('r_frame_rate')
@@ -79,24 +226,54 @@ def get_video_info(filepath):
         else:
             print(f"Warning: r_frame_rate not found in video stream info for {filepath}. Framerate will not be changed.")
         
-        return width, height, duration, original_fps
+        return width, height, duration, original_fps, video_codec, audio_codec
 
-    except FileNotFoundError:
-        print("Error: ffprobe command not found. Please ensure ffprobe is installed and in your PATH.")
-        return None, None, None, None
     except subprocess.CalledProcessError as e:
         print(f"Error running ffprobe for {filepath}: {e}")
         print(f"ffprobe stderr: {e.stderr.decode(errors='ignore')}")
-        return None, None, None, None
-    except json.JSONDecodeError as e:
+        return NO_VIDEO_INFO
+    except _json.JSONDecodeError as e:
         print(f"Error decoding JSON from ffprobe for {filepath}: {e}")
-        return None, None, None, None
+        return NO_VIDEO_INFO
     except (KeyError, IndexError) as e:
         print(f"Error parsing ffprobe JSON (KeyError/IndexError) for {filepath}: {e}")
-        return None, None, None, None
+        return NO_VIDEO_INFO
     except Exception as e:
         print(f"An unexpected error occurred while getting video info for {filepath}: {e}")
-        return None, None, None, None
+        return NO_VIDEO_INFO
+
+def conversion_key(input_path, encoder):
+    try:
+        st = os.stat(input_path)
+    except OSError:
+        return None
+    # The settings are part of the key, so changing the codec or a constant converts the file again
+    settings = (f"{encoder}:{MAX_SIZE_MB}:{DEFAULT_CRF}:{ENCODING_PRESET}:{DEFAULT_VIDEO_BITRATE}:"
+                f"{AUDIO_BITRATE}:{MAX_HEIGHT_UNTIL_HALVE}")
+    fingerprint = f"{st.st_mtime_ns}:{st.st_size}:{os.path.abspath(input_path)}:{settings}"
+    return hashlib.blake2b(fingerprint.encode(errors='surrogateescape'), digest_size=16).hexdigest()
+
+@functools.lru_cache(maxsize=1)
+def load_done_cache():
+    try:
+        with open(DONE_CACHE_PATH, encoding='utf-8') as f:
+            entries = json.load(f)
+        return entries if isinstance(entries, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def save_done_cache(new_entries):
+    # Only the main process writes this file, the conversion jobs just read it
+    entries = dict(load_done_cache())
+    entries.update(new_entries)
+    temp_path = f"{DONE_CACHE_PATH}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f)
+        os.replace(temp_path, DONE_CACHE_PATH)
+    except OSError as e:
+        print(f"Warning: Could not write conversion cache {DONE_CACHE_PATH}: {e}")
 
 def calculate_target_framerate(original_fps_val):
     if original_fps_val is None or original_fps_val <= 0:
@@ -113,172 +290,485 @@ def calculate_target_framerate(original_fps_val):
     
     return target_fps if changed else None
 
-def calculate_target_bitrate(duration_sec, max_size_mb, audio_bitrate):
+# buffer_seconds: -bufsize in seconds of video bitrate, which a capped encode may overshoot the average by
+def calculate_target_bitrate(duration_sec, max_size_mb, audio_bitrate, buffer_seconds=0):
     max_bits = max_size_mb * 8 * 1024 * 1024
     if duration_sec <= 0:
         print("Warning: Video duration is zero or negative. Using default bitrate for calculation.")
         return DEFAULT_VIDEO_BITRATE 
-    video_bitrate_target = (max_bits / duration_sec) - audio_bitrate
+    video_bitrate_target = (max_bits - audio_bitrate * duration_sec) / (duration_sec + buffer_seconds)
     return max(100_000, int(video_bitrate_target))
 
-def convert_video(input_path):
+@functools.lru_cache(maxsize=None)
+def pick_video_encoder():
+    if not USE_HARDWARE_ENCODER:
+        return "libx264"
+    try:
+        result = subprocess.run([FFMPEG, "-hide_banner", "-encoders"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Warning: Could not list ffmpeg encoders ({e}). Using libx264.")
+        return "libx264"
+
+    available = {line.split()[1] for line in result.stdout.splitlines() if len(line.split()) > 1}
+    for encoder, _, _ in HARDWARE_ENCODERS:
+        if encoder not in available:
+            continue
+        # Builds often list hardware encoders the machine can't actually use, so try a tiny encode first
+        test_cmd = [FFMPEG, "-hide_banner", "-loglevel", "error", "-f", "lavfi",
+                    "-i", "color=size=256x256:duration=0.1", "-c:v", encoder, "-f", "null", "-"]
+        try:
+            subprocess.run(test_cmd, capture_output=True, check=True, timeout=30)
+            return encoder
+        except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            continue
+    return "libx264"
+
+def is_hardware_encoder(encoder):
+    return any(name == encoder for name, _, _ in HARDWARE_ENCODERS)
+
+def video_encoder_options(encoder):
+    for name, options, _ in (*HARDWARE_ENCODERS, *CRF_ENCODERS.values()):
+        if name == encoder:
+            return ("-c:v", name, *options)
+    return LIBX264_VIDEO_OPTIONS
+
+def output_video_codec(encoder):
+    # Codec name as ffprobe reports it for what this encoder produces
+    for codec, (name, _, _) in CRF_ENCODERS.items():
+        if name == encoder:
+            return codec
+    return "h264"
+
+def hardware_bitrate_options(encoder, bitrate):
+    average = bitrate * 9 // 10 if encoder == "h264_qsv" else bitrate
+    return ("-b:v", str(average), "-maxrate", str(bitrate), "-bufsize", str(2 * bitrate))
+
+def video_quality_options(encoder):
+    for name, _, quality_options in (*HARDWARE_ENCODERS, *CRF_ENCODERS.values()):
+        if name == encoder:
+            return quality_options
+    return LIBX264_QUALITY_OPTIONS
+
+def _stat_or_none(path):
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+def remove_pass_logs(pass_log_prefix):
+    # ffmpeg names these e.g. <prefix>-0.log and <prefix>-0.log.mbtree, so match on the prefix
+    prefix_name = os.path.basename(pass_log_prefix)
+    dirname = os.path.dirname(pass_log_prefix) or '.'
+    try:
+        with os.scandir(dirname) as entries:
+            for entry in entries:
+                if entry.name == prefix_name or entry.name.startswith((f"{prefix_name}-", f"{prefix_name}.")):
+                    try: os.unlink(entry.path)
+                    except OSError as e_remove: print(f"Warning: Could not remove log file {entry.path}: {e_remove}")
+    except OSError as e_scan:
+        print(f"Warning: Could not clean up 2-pass log files in {dirname}: {e_scan}")
+
+def run_ffmpeg(cmd, duration=None, max_bytes=None, project_size=False):
+    # Drain stderr while ffmpeg runs so a full pipe can't stall it, keeping only the last lines for errors.
+    # With max_bytes, ffmpeg also reports its progress on stdout and is stopped once the output is larger
+    # than that, or with project_size also once it's projected to end up larger; the projected size is
+    # returned in that case. Only project for encoders that spread bits evenly over time: two-pass and
+    # CRF deliberately spend more on complex parts, which would make the projection stop encodes that fit.
+    watch_size = max_bytes is not None and bool(duration)
+    if watch_size:
+        cmd = (cmd[0], "-progress", "pipe:1", *cmd[1:])
+    creationflags = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE if watch_size else None, stderr=subprocess.PIPE,
+                            text=True, errors='ignore', bufsize=1, creationflags=creationflags)
+    stderr_tail = deque(maxlen=FFMPEG_STDERR_LINES)
+    readers = [threading.Thread(target=lambda: stderr_tail.extend(proc.stderr), daemon=True)]
+
+    projected_size = None
+    def watch_progress():
+        nonlocal projected_size
+        total_size = 0
+        out_time = 0.0
+        for line in proc.stdout:
+            key, _, value = line.strip().partition('=')
+            try:
+                if key == 'total_size':
+                    total_size = int(value)
+                elif key in ('out_time_us', 'out_time_ms'): # out_time_ms is in microseconds as well
+                    out_time = int(value) / 1_000_000
+            except ValueError:
+                continue
+            if key != 'progress' or projected_size is not None or out_time <= 0:
+                continue
+            projection = total_size * duration / out_time
+            if total_size > max_bytes or (project_size and out_time >= duration * OVERSIZE_CHECK_FROM
+                                          and projection > max_bytes):
+                projected_size = max(total_size, projection)
+                proc.kill()
+
+    if watch_size:
+        readers.append(threading.Thread(target=watch_progress, daemon=True))
+    for reader in readers:
+        reader.start()
+    returncode = proc.wait()
+    for reader in readers:
+        reader.join()
+    proc.stderr.close()
+    if watch_size:
+        proc.stdout.close()
+    if projected_size is not None:
+        return projected_size
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, stderr="".join(stderr_tail))
+    return None
+
+def is_faststart_mp4(path):
+    # Walk the top-level MP4 boxes: faststart means the moov box comes before the media data
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                box_size, box_type = struct.unpack(">I4s", header)
+                if box_type == b'moov':
+                    return True
+                if box_type == b'mdat':
+                    return False
+                if box_size == 1:
+                    box_size = struct.unpack(">Q", f.read(8))[0] - 8
+                elif box_size == 0:
+                    return False
+                f.seek(box_size - 8, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return False
+
+def copy_compliant_video(input_path, temp_output, final_output):
+    _, ext = os.path.splitext(input_path)
+    tag = f"[{os.path.basename(input_path)}] "
+    try:
+        if ext.lower() in ('.mp4', '.m4v') and is_faststart_mp4(input_path):
+            print(f"{tag}Input is already a faststart MP4. Copying it as-is...")
+            shutil.copyfile(input_path, temp_output)
+        else:
+            print(f"{tag}Remuxing to MP4 without re-encoding...")
+            # Map the streams whose codecs were checked, ffmpeg's default pick could be another audio track
+            run_ffmpeg((FFMPEG, "-y", "-i", input_path, "-map", "0:v:0", "-map", "0:a:0?",
+                        "-c", "copy", "-movflags", "+faststart",
+                        "-hide_banner", "-loglevel", "error", temp_output))
+        os.replace(temp_output, final_output)
+        return True
+    except subprocess.CalledProcessError as e:
+        print(f"{tag}Could not remux without re-encoding, encoding instead: {e}")
+        print(f"{tag}ffmpeg stderr: {e.stderr}")
+    except OSError as e:
+        print(f"Could not copy {input_path} to {final_output}, encoding instead: {e}")
+    if _stat_or_none(temp_output) is not None:
+        try: os.unlink(temp_output)
+        except OSError as rm_err: print(f"Could not remove temp file {temp_output}: {rm_err}")
+    return False
+
+def convert_video(input_path, threads=None, encoder=None, force=False):
     if not os.path.isfile(input_path):
         print(f"File not found: {input_path}")
         return
 
     base, _ = os.path.splitext(input_path)
+    # Jobs run in parallel, so every step message says which file it belongs to
+    tag = f"[{os.path.basename(input_path)}] "
     temp_output = f"{base}_temp.mp4"
     final_output = f"{base}_discordpressed.mp4"
 
-    print(f"\nProcessing: {input_path} (Preset: {ENCODING_PRESET})")
-    width, height, duration, original_fps = get_video_info(input_path)
+    encoder = encoder or pick_video_encoder()
+
+    if not force:
+        key = conversion_key(input_path, encoder)
+        done_output = load_done_cache().get(key) if key else None
+        done_st = _stat_or_none(done_output) if done_output else None
+        if done_st is not None and 0 < done_st.st_size <= MAX_OUTPUT_BYTES:
+            print(f"\nSkipping: {input_path} (already converted to {done_output})")
+            return done_output
+
+    encoder_display = f"libx264, Preset: {ENCODING_PRESET}" if encoder == "libx264" else encoder
+    print(f"\nProcessing: {input_path} (Encoder: {encoder_display})")
+    width, height, duration, original_fps, video_codec, audio_codec = get_video_info(input_path)
 
     if None in (width, height, duration):
-        print("Could not retrieve essential video info (width, height, or duration). Aborting conversion.")
+        print(f"{tag}Could not retrieve essential video info (width, height, or duration). Aborting conversion.")
         return
 
     fps_display = f"{original_fps:.2f}" if original_fps else "N/A"
-    print(f"Resolution: {width}x{height}, Duration: {duration:.2f}s, Original FPS: {fps_display}")
+    print(f"{tag}Resolution: {width}x{height}, Duration: {duration:.2f}s, Original FPS: {fps_display}")
+
+    input_st = _stat_or_none(input_path)
+    if (input_st is not None and input_st.st_size <= MAX_SIZE_MB * 1024 * 1024
+            and height <= MAX_HEIGHT_UNTIL_HALVE and calculate_target_framerate(original_fps) is None
+            and video_codec == output_video_codec(encoder) and audio_codec in (None, "aac")):
+        print(f"{tag}Input is {input_st.st_size / (1024 * 1024):.2f}MB, already {video_codec}/{audio_codec or 'no audio'} "
+              f"and needs no scaling or framerate change.")
+        if copy_compliant_video(input_path, temp_output, final_output):
+            print(f"Final file: {final_output} ({input_st.st_size / (1024 * 1024):.2f}MB)")
+            return final_output
 
     vf_filters = []
-    if height > MAX_HEIGHT_UNTIL_HALVE:
-        scale_filter_value = "scale=trunc(iw/2/2)*2:trunc(ih/2/2)*2"
-        vf_filters.append(scale_filter_value)
-        print(f"Scaling: Video height {height}px > {MAX_HEIGHT_UNTIL_HALVE}px. Applying filter: {scale_filter_value}")
-    
+    # fps goes before scale, so frames that get dropped are never scaled
     target_fps_val = None
     if original_fps:
         target_fps_val = calculate_target_framerate(original_fps)
         if target_fps_val:
             fps_filter_value = f"fps=fps={target_fps_val:.2f}"
             vf_filters.append(fps_filter_value)
-            print(f"Framerate: Original {original_fps:.2f}fps. Adjusting to {target_fps_val:.2f}fps.")
+            print(f"{tag}Framerate: Original {original_fps:.2f}fps. Adjusting to {target_fps_val:.2f}fps.")
         else:
-            print(f"Framerate: Original {original_fps:.2f}fps. No change needed.")
-
-    vf_args = ["-vf", ",".join(vf_filters)] if vf_filters else []
-
-    common_video_options = [
-        "-c:v", "libx264",
-        "-preset", ENCODING_PRESET
-    ]
-    common_ffmpeg_options = [
-        "-c:a", "aac", "-b:a", str(AUDIO_BITRATE),
-        "-movflags", "+faststart", "-hide_banner", "-loglevel", "error", "-stats"
-    ]
-
-    print("1. Trying default bitrate encoding (single pass)...")
-    cmd_pass1_default = [
-        "ffmpeg", "-y", "-i", input_path,
-        *common_video_options,
-        "-b:v", str(DEFAULT_VIDEO_BITRATE),
-        *common_ffmpeg_options,
-        *vf_args,
-        temp_output
-    ]
-    try:
-        subprocess.run(cmd_pass1_default, check=True, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        print(f"Error during default bitrate encoding: {e}")
-        print(f"ffmpeg stderr: {e.stderr.decode(errors='ignore')}")
-        if os.path.exists(temp_output): 
-            try: os.remove(temp_output)
-            except OSError as rm_err: print(f"Could not remove temp file {temp_output}: {rm_err}")
-        return
-
-    if not os.path.exists(temp_output) or os.path.getsize(temp_output) == 0:
-        print("Error: First pass encoding failed to produce a valid output file.")
-        if os.path.exists(temp_output): 
-            try: os.remove(temp_output)
-            except OSError as rm_err: print(f"Could not remove temp file {temp_output}: {rm_err}")
-        return
+            print(f"{tag}Framerate: Original {original_fps:.2f}fps. No change needed.")
 
-    final_size_mb = os.path.getsize(temp_output) / (1024 * 1024)
+    if height > MAX_HEIGHT_UNTIL_HALVE:
+        # Keep iw/ih instead of literal sizes: ffmpeg autorotates phone videos before filtering,
+        # so the probed width and height can be swapped compared to what the filter sees
+        scale_filter_value = "scale=trunc(iw/2/2)*2:trunc(ih/2/2)*2:flags=area"
+        vf_filters.append(scale_filter_value)
+        print(f"{tag}Scaling: Video height {height}px > {MAX_HEIGHT_UNTIL_HALVE}px. Applying filter: {scale_filter_value}")
 
-    if final_size_mb <= MAX_SIZE_MB:
-        print(f"Output is {final_size_mb:.2f}MB — keeping it.")
-        if os.path.exists(final_output): 
-            try: os.remove(final_output)
-            except OSError as e_rm: print(f"Could not remove existing {final_output}: {e_rm}")
-        try:
-            os.rename(temp_output, final_output)
-        except OSError: 
-            try:
-                shutil.copy2(temp_output, final_output)
-                os.remove(temp_output)
-                print("Used copy & delete as rename fallback.")
-            except Exception as e_copy:
-                print(f"Error renaming/copying {temp_output} to {final_output}: {e_copy}")
-                return
-    else:
-        print(f"Output is {final_size_mb:.2f}MB — too large. Re-encoding for ≤ {MAX_SIZE_MB}MB (2-pass).")
-        if os.path.exists(temp_output): 
-            try: os.remove(temp_output)
-            except OSError as rm_err: print(f"Could not remove oversized temp file {temp_output}: {rm_err}")
+    vf_args = ("-vf", ",".join(vf_filters)) if vf_filters else ()
 
-        target_bitrate = calculate_target_bitrate(duration, MAX_SIZE_MB, AUDIO_BITRATE)
-        print(f"Targeting video bitrate: {target_bitrate / 1000:.0f} kbps for 2-pass.")
+    common_video_options = video_encoder_options(encoder)
+    if threads:
+        common_video_options = (*common_video_options, "-threads", str(threads))
 
-        if target_bitrate < 100_000:
-            print(f"Warning: Calculated target video bitrate ({target_bitrate / 1000:.0f} kbps) is very low. Quality may be poor.")
+    target_bitrate = calculate_target_bitrate(duration, MAX_SIZE_MB, AUDIO_BITRATE)
+    # -bufsize lets the encoder go over -maxrate by up to one full buffer, so leave room for that too
+    vbv_slack_bits = 2 * DEFAULT_VIDEO_BITRATE
+    fits_single_pass = ((DEFAULT_VIDEO_BITRATE + AUDIO_BITRATE) * duration + vbv_slack_bits
+                        <= MAX_SIZE_MB * 8 * 1024 * 1024)
 
-        pass_log_prefix = f"{base}_2passlog"
-        pass1_cmd = [
-            "ffmpeg", "-y", "-i", input_path,
+    single_pass_done = False
+    if fits_single_pass:
+        print(f"{tag}Default bitrate fits within {MAX_SIZE_MB}MB. Encoding in a single pass (capped at {DEFAULT_VIDEO_BITRATE / 1000:.0f} kbps)...")
+        single_pass_cmd = (
+            FFMPEG, "-y", *INPUT_OPTIONS, "-i", input_path,
             *common_video_options,
-            "-b:v", str(target_bitrate),
-            "-pass", "1", "-passlogfile", pass_log_prefix, "-an",
-            *vf_args, "-f", "mp4", os.devnull if os.name != 'nt' else "NUL",
-            "-hide_banner", "-loglevel", "error"
-        ]
-        pass2_cmd = [
-            "ffmpeg", "-y", "-i", input_path,
-            *common_video_options,
-            "-b:v", str(target_bitrate),
-            "-pass", "2", "-passlogfile", pass_log_prefix,
-            *common_ffmpeg_options,
+            *video_quality_options(encoder),
+            "-maxrate", str(DEFAULT_VIDEO_BITRATE), "-bufsize", str(2 * DEFAULT_VIDEO_BITRATE),
+            *COMMON_FFMPEG_OPTIONS,
             *vf_args,
-            final_output
-        ]
+            temp_output
+        )
+        try:
+            oversized = run_ffmpeg(single_pass_cmd, duration, MAX_OUTPUT_BYTES)
+        except subprocess.CalledProcessError as e:
+            print(f"{tag}Error during single pass encoding: {e}")
+            print(f"{tag}ffmpeg stderr: {e.stderr}")
+            if _stat_or_none(temp_output) is not None:
+                try: os.unlink(temp_output)
+                except OSError as rm_err: print(f"Could not remove temp file {temp_output}: {rm_err}")
+            if is_hardware_encoder(encoder):
+                print(f"Retrying {input_path} with libx264...")
+                return convert_video(input_path, threads, "libx264", force=True)
+            return
+
+        temp_st = _stat_or_none(temp_output)
+        if oversized is not None:
+            print(f"{tag}Output went over {MAX_SIZE_MB}MB. Stopped encoding early, targeting the size instead.")
+            if temp_st is not None:
+                try: os.unlink(temp_output)
+                except OSError as rm_err: print(f"Could not remove oversized temp file {temp_output}: {rm_err}")
+        elif temp_st is None or temp_st.st_size == 0:
+            print(f"{tag}Error: Single pass encoding failed to produce a valid output file.")
+            if temp_st is not None:
+                try: os.unlink(temp_output)
+                except OSError as rm_err: print(f"Could not remove temp file {temp_output}: {rm_err}")
+            return
+        else:
+            final_size_mb = temp_st.st_size / (1024 * 1024)
+            print(f"{tag}Output is {final_size_mb:.2f}MB — keeping it.")
+            try:
+                os.replace(temp_output, final_output)
+            except OSError as e_replace:
+                print(f"Error moving {temp_output} to {final_output}: {e_replace}")
+                return
+            single_pass_done = True
+
+    if not single_pass_done:
+        two_pass = encoder == "libx264"
+        capped_crf = encoder in {name for name, _, _ in CRF_ENCODERS.values()}
+        mode_display = "2-pass" if two_pass else "capped CRF" if capped_crf else "single pass VBR"
+        if not two_pass:
+            # Only -maxrate/-bufsize limit these, so reserve the buffer like fits_single_pass does
+            target_bitrate = calculate_target_bitrate(duration, MAX_SIZE_MB, AUDIO_BITRATE, 2)
+        if not fits_single_pass:
+            print(f"{tag}Default bitrate would exceed {MAX_SIZE_MB}MB. Encoding for ≤ {MAX_SIZE_MB}MB ({mode_display}).")
+        print(f"{tag}Targeting video bitrate: {target_bitrate / 1000:.0f} kbps for {mode_display}.")
 
-        print("Running 2-pass: Pass 1...")
+        if target_bitrate < 100_000:
+            print(f"{tag}Warning: Calculated target video bitrate ({target_bitrate / 1000:.0f} kbps) is very low. Quality may be poor.")
+
+        pass_log_prefix = f"{base}_2passlog_{os.getpid()}"
+        # Returns (name, command, whether its output size is watched, whether it may be projected) for every ffmpeg run needed
+        def build_encode_steps(video_bitrate):
+            if two_pass:
+                pass1_cmd = (
+                    FFMPEG, "-y", *INPUT_OPTIONS, "-i", input_path,
+                    *common_video_options,
+                    "-b:v", str(video_bitrate),
+                    "-pass", "1", "-passlogfile", pass_log_prefix, "-an",
+                    *vf_args, "-f", "null", "-",
+                    "-hide_banner", "-loglevel", "error"
+                )
+                pass2_cmd = (
+                    FFMPEG, "-y", *INPUT_OPTIONS, "-i", input_path,
+                    *common_video_options,
+                    "-b:v", str(video_bitrate),
+                    "-pass", "2", "-passlogfile", pass_log_prefix,
+                    *COMMON_FFMPEG_OPTIONS,
+                    *vf_args,
+                    final_output
+                )
+                return [("2-pass: Pass 1", pass1_cmd, False, False), ("2-pass: Pass 2", pass2_cmd, True, False)]
+            elif capped_crf:
+                crf_cmd = (
+                    FFMPEG, "-y", *INPUT_OPTIONS, "-i", input_path,
+                    *common_video_options,
+                    *video_quality_options(encoder),
+                    "-maxrate", str(video_bitrate), "-bufsize", str(2 * video_bitrate),
+                    *COMMON_FFMPEG_OPTIONS,
+                    *vf_args,
+                    final_output
+                )
+                return [("capped CRF", crf_cmd, True, False)]
+            else:
+                # Hardware encoders have no two-pass log, their single pass VBR is close enough in size
+                vbr_cmd = (
+                    FFMPEG, "-y", *INPUT_OPTIONS, "-i", input_path,
+                    *common_video_options,
+                    *hardware_bitrate_options(encoder, video_bitrate),
+                    *COMMON_FFMPEG_OPTIONS,
+                    *vf_args,
+                    final_output
+                )
+                return [("single pass VBR", vbr_cmd, True, True)]
+
+        # Encodes that overshoot are stopped early and redone once at a lower bitrate. Pass 1 stats don't
+        # depend on the bitrate, so a retry only reruns the steps that write the output.
+        video_bitrate = target_bitrate
+        retry_with_libx264 = False
         try:
-            subprocess.run(pass1_cmd, check=True, stderr=subprocess.PIPE)
-            print("Running 2-pass: Pass 2...")
-            subprocess.run(pass2_cmd, check=True, stderr=subprocess.PIPE)
+            for attempt in range(2):
+                projected_size = None
+                for step_name, step_cmd, watch_size, project_size in build_encode_steps(video_bitrate):
+                    if attempt > 0 and not watch_size:
+                        continue
+                    print(f"{tag}Running {step_name}...")
+                    projected_size = run_ffmpeg(step_cmd, duration, MAX_OUTPUT_BYTES if watch_size else None,
+                                                project_size)
+                    if projected_size is not None:
+                        break
+                if projected_size is None:
+                    break
+                print(f"{tag}Output was heading for {projected_size / (1024 * 1024):.2f}MB. Stopped encoding early.")
+                if attempt == 0:
+                    video_bitrate = max(100_000, int(video_bitrate * MAX_OUTPUT_BYTES / projected_size * 0.9))
+                    print(f"{tag}Retrying at {video_bitrate / 1000:.0f} kbps.")
+            else:
+                print(f"Error: Output would still be larger than {MAX_SIZE_MB}MB. Giving up on {input_path}.")
+                if _stat_or_none(final_output) is not None:
+                    try: os.unlink(final_output)
+                    except OSError as rm_err: print(f"Could not remove oversized final_output {final_output}: {rm_err}")
         except subprocess.CalledProcessError as e:
-            print(f"Error during 2-pass encoding: {e}")
-            print(f"ffmpeg stderr: {e.stderr.decode(errors='ignore')}")
-            if os.path.exists(final_output): 
-                try: os.remove(final_output)
+            print(f"{tag}Error during {mode_display} encoding: {e}")
+            print(f"{tag}ffmpeg stderr: {e.stderr}")
+            if _stat_or_none(final_output) is not None:
+                try: os.unlink(final_output)
                 except OSError as rm_err: print(f"Could not remove failed final_output {final_output}: {rm_err}")
+            retry_with_libx264 = is_hardware_encoder(encoder)
         finally:
-            for ext in ['', '.log', '.log.mbtree', '.log.temp']:
-                log_file = f"{pass_log_prefix}{ext}"
-                if os.path.exists(log_file):
-                    try: os.remove(log_file)
-                    except OSError as e_remove: print(f"Warning: Could not remove log file {log_file}: {e_remove}")
-            if os.path.exists(temp_output):
-                try: os.remove(temp_output)
+            remove_pass_logs(pass_log_prefix)
+            if _stat_or_none(temp_output) is not None:
+                try: os.unlink(temp_output)
                 except OSError as e_remove: print(f"Warning: Could not remove leftover temp_output {temp_output}: {e_remove}")
 
-    if os.path.exists(final_output) and os.path.getsize(final_output) > 0:
-        final_size_check_mb = os.path.getsize(final_output) / (1024 * 1024)
+        if retry_with_libx264:
+            print(f"Retrying {input_path} with libx264...")
+            return convert_video(input_path, threads, "libx264", force=True)
+
+    final_st = _stat_or_none(final_output)
+    if final_st is not None and final_st.st_size > 0:
+        final_size_check_mb = final_st.st_size / (1024 * 1024)
         print(f"Final file: {final_output} ({final_size_check_mb:.2f}MB)")
-        if final_size_check_mb > MAX_SIZE_MB + 0.5:
-             print(f"Warning: Final file size ({final_size_check_mb:.2f}MB) is over target {MAX_SIZE_MB}MB.")
-    elif not os.path.exists(final_output) or os.path.getsize(final_output) == 0 :
+        if final_st.st_size > MAX_OUTPUT_BYTES:
+             print(f"{tag}Warning: Final file size ({final_size_check_mb:.2f}MB) is over target {MAX_SIZE_MB}MB.")
+        return final_output
+    else:
         print(f"Error: Final output file {final_output} was not created or is empty.")
-        if os.path.exists(final_output) and os.path.getsize(final_output) == 0:
-            try: os.remove(final_output)
+        if final_st is not None:
+            try: os.unlink(final_output)
             except OSError as e_remove: print(f"Warning: Could not remove empty final_output {final_output}: {e_remove}")
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python script_name.py <video_file1> [video_file2 ...]")
-        sys.exit(1)
+def convert_videos(paths, threads=None, encoder=None, force=False):
+    # Runs one after another, used for inputs that would write the same output files
+    return [convert_video(path_arg, threads, encoder, force) for path_arg in paths]
+
+def main():
+    parser = argparse.ArgumentParser(description="Compress videos to fit within Discord's upload limit.")
+    parser.add_argument("paths", nargs="+", metavar="video_file", help="video file(s) to convert")
+    parser.add_argument("--jobs", "-j", type=int, default=None,
+                        help=f"number of files to convert at once (default: half the CPU cores, or {MAX_HARDWARE_JOBS} with a hardware encoder)")
+    parser.add_argument("--force", "-f", action="store_true",
+                        help="convert files again even if they were already converted")
+    parser.add_argument("--codec", choices=("h264", "hevc", "av1"), default="h264",
+                        help="video codec of the result; hevc and av1 give smaller files but older devices may not play them (default: h264)")
+    args = parser.parse_args()
+
+    if FFMPEG is None:
+        sys.exit("Error: ffmpeg not found. Please ensure FFmpeg is installed and in your PATH.")
+    if FFPROBE is None and av is None:
+        sys.exit("Error: ffprobe not found. Please ensure FFmpeg (including ffprobe) is installed and in your PATH.")
+
+    # Inputs like clip.mp4 and clip.mov share clip_temp.mp4 and clip_discordpressed.mp4, so they go in one job
+    path_groups = {}
+    for path_arg in args.paths:
+        stem = os.path.normcase(os.path.splitext(os.path.abspath(path_arg))[0])
+        path_groups.setdefault(stem, []).append(path_arg)
+    path_groups = list(path_groups.values())
+
+    encoder = CRF_ENCODERS[args.codec][0] if args.codec in CRF_ENCODERS else pick_video_encoder()
+    hardware = is_hardware_encoder(encoder)
+    cpu_count = os.cpu_count() or 2
+    jobs = args.jobs or (MAX_HARDWARE_JOBS if hardware else max(1, cpu_count // 2))
+    jobs = max(1, min(jobs, len(path_groups)))
+
+    outputs = {}
+    if jobs == 1:
+        for path_arg in args.paths:
+            outputs[path_arg] = convert_video(path_arg, encoder=encoder, force=args.force)
+    else:
+        # Each worker runs its own pass 1 and pass 2, so one file's pass 1 already overlaps another's pass 2.
+        # Starting the biggest files first keeps the batch from ending on one long encode with idle cores.
+        def input_size(path_arg):
+            # Missing or unreadable paths sort last, convert_video reports them
+            try:
+                return os.path.getsize(path_arg)
+            except OSError:
+                return 0
+        ordered_groups = sorted(path_groups, key=lambda group: sum(map(input_size, group)), reverse=True)
+        # Hardware encodes barely use the CPU, so only split threads between software encodes
+        threads = None if hardware else max(1, cpu_count // jobs)
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(convert_videos, group, threads, encoder, args.force) for group in ordered_groups]
+            for group, future in zip(ordered_groups, futures):
+                try:
+                    outputs.update(zip(group, future.result()))
+                except Exception as e:
+                    print(f"An unexpected error occurred while converting {', '.join(group)}: {e}")
+
+    done_entries = {}
+    for path_arg, final_output in outputs.items():
+        key = conversion_key(path_arg, encoder) if final_output else None
+        if key:
+            done_entries[key] = os.path.abspath(final_output)
+    if done_entries:
+        save_done_cache(done_entries)
+
+    encoder_display = f"libx264, preset {ENCODING_PRESET}" if encoder == "libx264" else encoder
+    print(f"\nAll conversions finished. Used encoder: {encoder_display}")
 
-    for path_arg in sys.argv[1:]:
-        convert_video(path_arg)
-    
-    print(f"\nAll conversions finished. Used preset: {ENCODING_PRESET}")
+if __name__ == "__main__":
+    main()